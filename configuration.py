@@ -48,6 +48,22 @@ class ConfigurationDefaultAccount(metaclass=PoolMeta):
             ('company', '=', Eval('company', -1)),
             ])
 
+    @classmethod
+    def create(cls, vlist):
+        records = super().create(vlist)
+        Pool().get('product.template').clear_accounting_defaults()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        Pool().get('product.template').clear_accounting_defaults()
+
+    @classmethod
+    def delete(cls, records):
+        super().delete(records)
+        Pool().get('product.template').clear_accounting_defaults()
+
 
 class ProductConfiguration(metaclass=PoolMeta):
     __name__ = 'product.configuration'
@@ -75,3 +91,19 @@ class ProductConfiguration(metaclass=PoolMeta):
     @classmethod
     def default_default_taxes_category(cls):
         return True
+
+    @classmethod
+    def create(cls, vlist):
+        records = super().create(vlist)
+        Pool().get('product.template').clear_accounting_defaults()
+        return records
+
+    @classmethod
+    def write(cls, *args):
+        super().write(*args)
+        Pool().get('product.template').clear_accounting_defaults()
+
+    @classmethod
+    def delete(cls, records):
+        super().delete(records)
+        Pool().get('product.template').clear_accounting_defaults()
@@ -1,9 +1,15 @@
 # This file is part account_product_accounting module for Tryton.
 # The COPYRIGHT file at the top level of this repository contains
 # the full copyright notices and license terms.
-from trytond.model import ModelSQL, fields
+import sqlite3
+
+from sql import Conflict
+from sql.functions import CurrentTimestamp
+
+from trytond.model import ModelSQL, Unique, fields
 from trytond.pyson import Eval
 from trytond import backend
+from trytond.cache import Cache
 from trytond.pool import PoolMeta, Pool
 from trytond.modules.company.model import (
     CompanyMultiValueMixin, CompanyValueMixin)
@@ -80,6 +86,8 @@ class Template(CompanyMultiValueMixin, metaclass=PoolMeta):
             'invisible': (~Eval('context', {}).get('company')
                 | Eval('taxes_category')),
             })
+    _accounting_defaults_cache = Cache(
+        'product.template.accounting_defaults', context=False)
 
     @classmethod
     def __setup__(cls):
@@ -126,34 +134,80 @@ class Template(CompanyMultiValueMixin, metaclass=PoolMeta):
         return super().multivalue_model(field)
 
     @classmethod
-    def default_account_expense(cls, **pattern):
-        Configuration = Pool().get('account.configuration')
+    def _multivalue_setter(cls, records, name, val):
+        pool = Pool()
+        TemplateAccount = pool.get('product.template.account')
+        company = Transaction().context.get('company')
+        if (cls.multivalue_model(name) == TemplateAccount
+                and company is not None
+                and TemplateAccount.has_upsert()):
+            TemplateAccount.upsert(records, name, val, company)
+        else:
+            super()._multivalue_setter(records, name, val)
+
+    @classmethod
+    def accounting_defaults(cls, company=None):
+        '''
+        Return a dictionary with the default accounting values of company.
+
+        The configurations are read once per company and cached until they
+        are modified. The result is a copy which may be changed by the caller.
+        '''
+        pool = Pool()
+        Configuration = pool.get('account.configuration')
+        ProductConfiguration = pool.get('product.configuration')
+        if company is None:
+            company = Transaction().context.get('company')
+        if company is not None:
+            company = int(company)
+        defaults = cls._accounting_defaults_cache.get(company)
+        if defaults is not None:
+            return dict(defaults)
+
         config = Configuration(1)
-        account = config.get_multivalue(
-            'default_product_account_expense', **pattern)
-        return account.id if account else None
+        product_config = ProductConfiguration(1)
+        account_expense = config.get_multivalue(
+            'default_product_account_expense', company=company)
+        account_revenue = config.get_multivalue(
+            'default_product_account_revenue', company=company)
+        defaults = {
+            'accounts_category': product_config.default_accounts_category,
+            'taxes_category': product_config.default_taxes_category,
+            'account_expense': (
+                account_expense.id if account_expense else None),
+            'account_revenue': (
+                account_revenue.id if account_revenue else None),
+            'supplier_taxes_deductible_rate': 1,
+            }
+        cls._accounting_defaults_cache.set(company, defaults)
+        return dict(defaults)
+
+    @classmethod
+    def clear_accounting_defaults(cls):
+        "Clear the cache of accounting_defaults"
+        cls._accounting_defaults_cache.clear()
+
+    @classmethod
+    def default_account_expense(cls, **pattern):
+        return cls.accounting_defaults(
+            pattern.get('company'))['account_expense']
 
     @classmethod
     def default_account_revenue(cls, **pattern):
-        Configuration = Pool().get('account.configuration')
-        config = Configuration(1)
-        account = config.get_multivalue(
-            'default_product_account_revenue', **pattern)
-        return account.id if account else None
+        return cls.accounting_defaults(
+            pattern.get('company'))['account_revenue']
 
     @classmethod
     def default_accounts_category(cls):
-        Config = Pool().get('product.configuration')
-        return Config(1).default_accounts_category
+        return cls.accounting_defaults()['accounts_category']
 
     @classmethod
     def default_taxes_category(cls):
-        Config = Pool().get('product.configuration')
-        return Config(1).default_taxes_category
+        return cls.accounting_defaults()['taxes_category']
 
     @classmethod
     def default_supplier_taxes_deductible_rate(cls):
-        return 1
+        return cls.accounting_defaults()['supplier_taxes_deductible_rate']
 
     def get_account(self, name, **pattern):
         if self.accounts_category:
@@ -219,6 +273,115 @@ class TemplateAccount(ModelSQL, CompanyValueMixin):
             ('company', '=', Eval('company', -1)),
             ])
 
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('template_company_unique', Unique(t, t.template, t.company),
+                'account_product_accounting.'
+                'msg_template_account_company_unique'),
+            ]
+
+    @classmethod
+    def __register__(cls, module_name):
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        exist = backend.TableHandler.table_exist(cls._table)
+
+        # Migration from 8.0: remove duplicated accounts per template and
+        # company to allow the unique constraint, keeping the first one
+        if exist:
+            account = cls.__table__()
+            other = cls.__table__()
+            duplicate = account.join(other, condition=(
+                    (account.template == other.template)
+                    & (account.company == other.company)
+                    & (account.id > other.id)))
+            cursor.execute(*table.delete(
+                    where=table.id.in_(duplicate.select(account.id))))
+
+        super().__register__(module_name)
+
+    @classmethod
+    def has_upsert(cls):
+        "Return True if the backend supports INSERT ... ON CONFLICT"
+        if backend.name == 'sqlite':
+            return sqlite3.sqlite_version_info >= (3, 24, 0)
+        return backend.name == 'postgresql'
+
+    @classmethod
+    def upsert(cls, templates, name, value, company):
+        '''
+        Set value of the field name for the templates and company.
+
+        The missing records are inserted by a single INSERT ... ON CONFLICT
+        DO NOTHING statement on the unique template and company constraint,
+        so concurrent transactions do not create duplicated records. The
+        value is then set with write, which checks the write access, stores
+        the history, runs the triggers and validates the records.
+
+        Concurrent writers still contend on the same keys: on PostgreSQL the
+        insert waits for a concurrent uncommitted insert of the same template
+        and company, and if that row is not visible to the snapshot of the
+        transaction, a serialization failure is raised and the transaction is
+        retried by Tryton.
+
+        The create access is checked only when records are missing. The
+        insert bypasses create: the create overrides, the create triggers,
+        the create history and the create rules are not run.
+        '''
+        pool = Pool()
+        Template = pool.get('product.template')
+        ModelAccess = pool.get('ir.model.access')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+
+        template_ids = sorted({int(t) for t in templates})
+        if not template_ids:
+            return
+
+        ModelAccess.check(cls.__name__, 'write')
+        records = cls.search([
+                ('template', 'in', template_ids),
+                ('company', '=', company),
+                ])
+        existing = {r.template.id for r in records}
+        template_ids = [t for t in template_ids if t not in existing]
+        if not template_ids:
+            cls.write(records, {name: value})
+            return
+        ModelAccess.check(cls.__name__, 'create')
+
+        # New records get the default value of the other fields like
+        # Template.multivalue_record does
+        defaults = {}
+        for fname, field in Template._fields.items():
+            if (fname != name
+                    and isinstance(field, fields.MultiValue)
+                    and Template.multivalue_model(fname) == cls):
+                func = getattr(Template, 'default_%s' % fname, None)
+                if func:
+                    defaults[fname] = func(company=company)
+
+        columns = [table.template, table.company, getattr(table, name)]
+        columns += [getattr(table, f) for f in defaults]
+        columns += [table.create_uid, table.create_date]
+        values = [
+            [t, company, value] + list(defaults.values())
+            + [transaction.user, CurrentTimestamp()]
+            for t in template_ids]
+        cursor.execute(*table.insert(columns, values,
+                on_conflict=Conflict(
+                    table, indexed_columns=[table.template, table.company])))
+
+        records += cls.search([
+                ('template', 'in', template_ids),
+                ('company', '=', company),
+                ])
+        cls.write(records, {name: value})
+
 
 class TemplateCustomerTax(ModelSQL):
     'Product Template - Customer Tax'
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+# This file is part account_product_accounting module for Tryton.
+# The COPYRIGHT file at the top level of this repository contains
+# the full copyright notices and license terms.
+"""
+Load test for the tax and account resolvers of product templates.
+
+It runs concurrent transactions against an existing database with the
+account_product_accounting module installed and calls customer_taxes_used and
+account_revenue_used as sale lines do, optionally mixed with writes of
+account_revenue. It reports the latency percentiles of each resolver and the
+lock waits observed during the run.
+
+Warning: with --write-ratio greater than 0 the script commits real writes of
+account_revenue (and of write_date and write_uid) to the target database.
+
+    $ python scripts/load_test.py -c trytond.conf -d mydb -w 16 -n 500
+"""
+import argparse
+import random
+import statistics
+import threading
+import time
+from collections import defaultdict
+
+from trytond.config import config
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('-c', '--config', dest='config',
+        help="the trytond configuration file")
+    parser.add_argument('-d', '--database', dest='database', required=True,
+        help="the database name (a file database for SQLite)")
+    parser.add_argument('-u', '--user', dest='user', default='admin',
+        help="the login of the user running the transactions")
+    parser.add_argument('-w', '--workers', dest='workers', type=int,
+        default=8, help="the number of concurrent transactions")
+    parser.add_argument('-n', '--iterations', dest='iterations', type=int,
+        default=200, help="the number of sale lines per worker")
+    parser.add_argument('--write-ratio', dest='write_ratio', type=float,
+        default=0.0, help="the ratio of lines also writing account_revenue "
+        "(warning: the writes are committed to the database)")
+    parser.add_argument('--seed', dest='seed', type=int, default=None,
+        help="the random seed")
+    return parser.parse_args()
+
+
+def load_mix(database, user_id):
+    "Return the template ids grouped by company and accounting source"
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    pool = Pool(database)
+    Company = pool.get('company.company')
+    Template = pool.get('product.template')
+    mix = defaultdict(list)
+    with Transaction().start(database, user_id, readonly=True):
+        for company in Company.search([]):
+            with Transaction().set_context(company=company.id):
+                for template in Template.search([]):
+                    key = (company.id,
+                        'category' if template.accounts_category
+                        else 'template',
+                        'category' if template.taxes_category
+                        else 'template')
+                    mix[key].append(template.id)
+    return mix
+
+
+def monitor_locks(database, stop, samples):
+    "Sample the number of lock waits on PostgreSQL until stop is set"
+    from trytond import backend
+
+    if backend.name != 'postgresql':
+        return
+    db = backend.Database(database).connect()
+    conn = db.get_connection(readonly=True, autocommit=True)
+    try:
+        cursor = conn.cursor()
+        while not stop.is_set():
+            cursor.execute(
+                'SELECT count(*) FROM pg_locks '
+                'WHERE NOT granted AND database = '
+                '(SELECT oid FROM pg_database WHERE datname = %s)',
+                (database,))
+            samples.append(cursor.fetchone()[0])
+            time.sleep(0.05)
+    finally:
+        db.put_connection(conn)
+
+
+def worker(database, user_id, mix, options, rnd, results):
+    from trytond import backend
+    from trytond.exceptions import UserError
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    pool = Pool(database)
+    Template = pool.get('product.template')
+    keys = list(mix)
+    weights = [len(mix[k]) for k in keys]
+    for _ in range(options.iterations):
+        key, = rnd.choices(keys, weights)
+        company, _, _ = key
+        template_id = rnd.choice(mix[key])
+        write = rnd.random() < options.write_ratio
+        start = time.perf_counter()
+        try:
+            with Transaction().start(database, user_id,
+                    readonly=not write, context={'company': company}):
+                template = Template(template_id)
+
+                begin = time.perf_counter()
+                template.customer_taxes_used
+                results['customer_taxes_used'].append(
+                    time.perf_counter() - begin)
+
+                begin = time.perf_counter()
+                try:
+                    account = template.account_revenue_used
+                except UserError:
+                    account = None
+                    results['missing_account'].append(1)
+                results['account_revenue_used'].append(
+                    time.perf_counter() - begin)
+
+                if write and not template.accounts_category:
+                    begin = time.perf_counter()
+                    Template.write([template], {
+                            'account_revenue': account.id if account else None,
+                            })
+                    results['write_account_revenue'].append(
+                        time.perf_counter() - begin)
+        except backend.DatabaseOperationalError:
+            # Lock timeouts, serialization failures and "database is locked"
+            results['lock_error'].append(1)
+        results['transaction'].append(time.perf_counter() - start)
+
+
+def percentiles(values):
+    if len(values) < 2:
+        return values * 3 if values else [float('nan')] * 3
+    quantiles = statistics.quantiles(values, n=100, method='inclusive')
+    return [quantiles[49], quantiles[94], quantiles[98]]
+
+
+def report(results, lock_samples, elapsed):
+    print("%-24s %8s %10s %10s %10s" % ('', 'count', 'p50 ms', 'p95 ms',
+            'p99 ms'))
+    for name in ['customer_taxes_used', 'account_revenue_used',
+            'write_account_revenue', 'transaction']:
+        values = results.get(name, [])
+        p50, p95, p99 = percentiles(values)
+        print("%-24s %8d %10.2f %10.2f %10.2f" % (
+                name, len(values), p50 * 1000, p95 * 1000, p99 * 1000))
+    transactions = len(results.get('transaction', []))
+    print("throughput: %.1f transactions/s" % (transactions / elapsed))
+    print("missing revenue accounts: %d" % len(
+            results.get('missing_account', [])))
+    print("lock errors: %d" % len(results.get('lock_error', [])))
+    if lock_samples:
+        print("lock waits: max %d, mean %.2f, sampled %d%% of time" % (
+                max(lock_samples), statistics.mean(lock_samples),
+                100 * sum(1 for s in lock_samples if s) / len(lock_samples)))
+    else:
+        print("lock waits: not sampled on this backend")
+
+
+def main():
+    options = parse_arguments()
+    config.update_etc(options.config)
+
+    from trytond.pool import Pool
+    from trytond.transaction import Transaction
+
+    Pool.start()
+    pool = Pool(options.database)
+    pool.init()
+
+    with Transaction().start(options.database, 0, readonly=True):
+        User = pool.get('res.user')
+        user, = User.search([('login', '=', options.user)])
+        user_id = user.id
+
+    mix = load_mix(options.database, user_id)
+    if not mix:
+        raise SystemExit("No product templates found")
+    for (company, accounts, taxes), template_ids in sorted(mix.items()):
+        print("company %s, accounts from %s, taxes from %s: %d templates" % (
+                company, accounts, taxes, len(template_ids)))
+
+    seed = random.Random(options.seed)
+    # Each worker has its own results to not share them between threads
+    worker_results = [defaultdict(list) for _ in range(options.workers)]
+    lock_samples = []
+    stop = threading.Event()
+    monitor = threading.Thread(target=monitor_locks,
+        args=(options.database, stop, lock_samples), daemon=True)
+    workers = [threading.Thread(target=worker,
+            args=(options.database, user_id, mix, options,
+                random.Random(seed.random()), results))
+        for results in worker_results]
+
+    monitor.start()
+    start = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    monitor.join()
+
+    results = defaultdict(list)
+    for values in worker_results:
+        for name, samples in values.items():
+            results[name].extend(samples)
+    report(results, lock_samples, elapsed)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,10 +3,14 @@
 # this repository contains the full copyright notices and license terms.
 
 from decimal import Decimal
+from unittest.mock import patch
 
 from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond import backend
 from trytond.pool import Pool
+from trytond.transaction import Transaction
 from trytond.exceptions import UserError
+from trytond.model.exceptions import AccessError
 
 from trytond.modules.company.tests import (CompanyTestMixin, create_company,
     set_company)
@@ -156,5 +160,308 @@ class AccountProductAccountingTestCase(CompanyTestMixin, ModuleTestCase):
             self.assertEqual(len(template.customer_taxes), 1)
             self.assertEqual(len(template.customer_taxes_used), 1)
 
+    @with_transaction()
+    def test_account_upsert(self):
+        'Test account write does not duplicate template accounts'
+        pool = Pool()
+        ProductTemplate = pool.get('product.template')
+        TemplateAccount = pool.get('product.template.account')
+        Uom = pool.get('product.uom')
+        Account = pool.get('account.account')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+
+            unit, = Uom.search([
+                    ('name', '=', 'Unit'),
+                    ])
+            account_expense, = Account.search([
+                    ('type.expense', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+            account_expense2, = Account.copy([account_expense])
+            account_revenue, = Account.search([
+                    ('type.revenue', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+
+            template1, template2 = ProductTemplate.create([{
+                        'name': 'test upsert 1',
+                        'default_uom': unit.id,
+                        'accounts_category': False,
+                        'taxes_category': False,
+                        }, {
+                        'name': 'test upsert 2',
+                        'default_uom': unit.id,
+                        'accounts_category': False,
+                        'taxes_category': False,
+                        }])
+            templates = [template1, template2]
+
+            ProductTemplate.write(templates, {
+                    'account_expense': account_expense.id,
+                    })
+            ProductTemplate.write(templates, {
+                    'account_expense': account_expense2.id,
+                    })
+            ProductTemplate.write([template1], {
+                    'account_revenue': account_revenue.id,
+                    })
+
+            for template in templates:
+                accounts = TemplateAccount.search([
+                        ('template', '=', template.id),
+                        ('company', '=', company.id),
+                        ])
+                self.assertEqual(len(accounts), 1)
+                self.assertEqual(template.account_expense, account_expense2)
+            self.assertEqual(template1.account_revenue, account_revenue)
+            self.assertEqual(template2.account_revenue, None)
+
+    @with_transaction()
+    def test_account_upsert_existing(self):
+        'Test account write conflicting with rows missing from the cache'
+        pool = Pool()
+        ProductTemplate = pool.get('product.template')
+        TemplateAccount = pool.get('product.template.account')
+        Uom = pool.get('product.uom')
+        Account = pool.get('account.account')
+        cursor = Transaction().connection.cursor()
+        table = TemplateAccount.__table__()
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+
+            unit, = Uom.search([
+                    ('name', '=', 'Unit'),
+                    ])
+            account_revenue, = Account.search([
+                    ('type.revenue', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+
+            template1, template2, template3 = ProductTemplate.create([{
+                        'name': 'test conflict %s' % i,
+                        'default_uom': unit.id,
+                        'accounts_category': False,
+                        'taxes_category': False,
+                        } for i in range(1, 4)])
+            templates = [template1, template2, template3]
+            self.assertTrue(TemplateAccount.has_upsert())
+
+            # Replace the rows with SQL after the templates were read, so the
+            # insert conflicts with rows the ORM has not seen
+            cursor.execute(*table.delete(
+                    where=table.template.in_([t.id for t in templates])))
+            cursor.execute(*table.insert(
+                    [table.template, table.company],
+                    [[template1.id, company.id], [template2.id, None]]))
+
+            ProductTemplate.write(templates, {
+                    'account_revenue': account_revenue.id,
+                    })
+
+            accounts = TemplateAccount.search([
+                    ('template', 'in', [t.id for t in templates]),
+                    ])
+            # Like set_multivalue, an account without company is not updated
+            self.assertEqual(
+                sorted((a.template.id, a.company.id if a.company else 0,
+                        a.account_revenue)
+                    for a in accounts),
+                [(template1.id, company.id, account_revenue),
+                    (template2.id, 0, None),
+                    (template2.id, company.id, account_revenue),
+                    (template3.id, company.id, account_revenue)])
+            for template in ProductTemplate.browse([template1, template3]):
+                self.assertEqual(template.account_revenue, account_revenue)
+
+    @with_transaction()
+    def test_account_upsert_access(self):
+        'Test account write needs create access only to add accounts'
+        pool = Pool()
+        ProductTemplate = pool.get('product.template')
+        TemplateAccount = pool.get('product.template.account')
+        ModelAccess = pool.get('ir.model.access')
+        Uom = pool.get('product.uom')
+        Account = pool.get('account.account')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+
+            unit, = Uom.search([
+                    ('name', '=', 'Unit'),
+                    ])
+            account_revenue, = Account.search([
+                    ('type.revenue', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+
+            template1, template2 = ProductTemplate.create([{
+                        'name': 'test access %s' % i,
+                        'default_uom': unit.id,
+                        'accounts_category': False,
+                        'taxes_category': False,
+                        } for i in range(1, 3)])
+            TemplateAccount.delete(TemplateAccount.search([
+                        ('template', '=', template2.id),
+                        ]))
+
+            ModelAccess.create([{
+                        'model': TemplateAccount.__name__,
+                        'group': None,
+                        'perm_read': True,
+                        'perm_write': True,
+                        'perm_create': False,
+                        'perm_delete': False,
+                        }])
+            with Transaction().set_context(_check_access=True):
+                TemplateAccount.upsert(
+                    [template1], 'account_revenue', account_revenue.id,
+                    company.id)
+                with self.assertRaises(AccessError):
+                    TemplateAccount.upsert(
+                        [template2], 'account_revenue', account_revenue.id,
+                        company.id)
+
+            self.assertEqual(template1.account_revenue, account_revenue)
+
+    @with_transaction()
+    def test_account_migration_duplicates(self):
+        'Test migration removes duplicated template accounts'
+        pool = Pool()
+        ProductTemplate = pool.get('product.template')
+        TemplateAccount = pool.get('product.template.account')
+        Uom = pool.get('product.uom')
+        cursor = Transaction().connection.cursor()
+        table = TemplateAccount.__table__()
+
+        company = create_company()
+        unit, = Uom.search([
+                ('name', '=', 'Unit'),
+                ])
+        template, = ProductTemplate.create([{
+                    'name': 'test migration',
+                    'default_uom': unit.id,
+                    'accounts_category': False,
+                    'taxes_category': False,
+                    }])
+
+        table_h = TemplateAccount.__table_handler__(
+            'account_product_accounting')
+        table_h.drop_constraint('template_company_unique')
+        cursor.execute(*table.delete(where=table.template == template.id))
+        cursor.execute(*table.insert(
+                [table.template, table.company],
+                [[template.id, company.id]] * 3 + [[template.id, None]]))
+        cursor.execute(*table.select(table.id,
+                where=table.template == template.id,
+                order_by=table.id))
+        first_id = cursor.fetchone()[0]
+
+        TemplateAccount.__register__('account_product_accounting')
+
+        cursor.execute(*table.select(table.id, table.company,
+                where=table.template == template.id,
+                order_by=table.id))
+        rows = cursor.fetchall()
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(tuple(rows[0]), (first_id, company.id))
+        self.assertEqual(rows[1][1], None)
+        with self.assertRaises(backend.DatabaseIntegrityError):
+            cursor.execute(*table.insert(
+                    [table.template, table.company],
+                    [[template.id, company.id]]))
+
+    @with_transaction()
+    def test_accounting_defaults(self):
+        'Test accounting defaults follow the configuration'
+        pool = Pool()
+        ProductTemplate = pool.get('product.template')
+        ProductCategory = pool.get('product.category')
+        ProductConfiguration = pool.get('product.configuration')
+        Configuration = pool.get('account.configuration')
+        Uom = pool.get('product.uom')
+        Account = pool.get('account.account')
+
+        company = create_company()
+        with set_company(company):
+            create_chart(company)
+
+            unit, = Uom.search([
+                    ('name', '=', 'Unit'),
+                    ])
+            account_revenue, = Account.search([
+                    ('type.revenue', '=', True),
+                    ('closed', '=', False),
+                    ], limit=1)
+
+            category, = ProductCategory.create([{
+                        'name': 'test defaults',
+                        'accounting': True,
+                        }])
+            template, = ProductTemplate.create([{
+                        'name': 'test defaults 1',
+                        'default_uom': unit.id,
+                        'account_category': category.id,
+                        }])
+            self.assertTrue(template.accounts_category)
+            self.assertTrue(template.taxes_category)
+            self.assertEqual(template.supplier_taxes_deductible_rate, 1)
+
+            product_config = ProductConfiguration(1)
+            product_config.default_accounts_category = False
+            product_config.default_taxes_category = False
+            product_config.save()
+            config = Configuration(1)
+            config.default_product_account_revenue = account_revenue
+            config.save()
+
+            self.assertEqual(ProductTemplate.accounting_defaults(), {
+                    'accounts_category': False,
+                    'taxes_category': False,
+                    'account_expense': None,
+                    'account_revenue': account_revenue.id,
+                    'supplier_taxes_deductible_rate': 1,
+                    })
+
+            templates = ProductTemplate.create([{
+                        'name': 'test defaults %s' % i,
+                        'default_uom': unit.id,
+                        } for i in range(2, 4)])
+            for template in templates:
+                self.assertFalse(template.accounts_category)
+                self.assertFalse(template.taxes_category)
+                self.assertEqual(template.account_revenue, account_revenue)
+
+            defaults = ProductTemplate.accounting_defaults()
+            defaults['account_revenue'] = None
+            self.assertEqual(
+                ProductTemplate.accounting_defaults()['account_revenue'],
+                account_revenue.id)
+
+            # The configuration is read once for a whole batch
+            ProductTemplate.clear_accounting_defaults()
+            get_multivalue = Configuration.get_multivalue
+            names = []
+
+            def count_get_multivalue(self, name, **pattern):
+                names.append(name)
+                return get_multivalue(self, name, **pattern)
+
+            with patch.object(
+                    Configuration, 'get_multivalue', count_get_multivalue):
+                templates = ProductTemplate.create([{
+                            'name': 'test batch %s' % i,
+                            'default_uom': unit.id,
+                            'account_expense': None,
+                            } for i in range(10)])
+            self.assertEqual(len(templates), 10)
+            self.assertEqual(names.count('default_product_account_expense'), 1)
+            self.assertEqual(names.count('default_product_account_revenue'), 1)
+
 
 del ModuleTestCase